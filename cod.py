@@ -2,12 +2,20 @@ import os
 import logging 
 import sqlite3 
 import json 
-import tempfile
+import pickle
+import io
+import hashlib
 import re
+import queue
+import asyncio
+import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from telegram import Update
-import pytz 
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter, TelegramError
 import google.generativeai as genai
 from telegram.ext import (
     Application, 
@@ -15,7 +23,7 @@ from telegram.ext import (
     MessageHandler,
     filters, 
     ContextTypes,
-    PicklePersistence
+    BasePersistence
 )
 
 load_dotenv()
@@ -33,15 +41,75 @@ if not TELEGRAM_TOKEN:
 if not GOOGLE_AI_API_KEY:
     raise ValueError("GOOGLE_AI_API_KEY não encontrado. Verifique seu arquivo .env")
 
-SAO_PAULO_TZ = pytz.timezone('America/Sao_Paulo')
+SAO_PAULO_TZ = ZoneInfo('America/Sao_Paulo')
+
+# gRPC já é o transporte padrão do google-generativeai; aqui só fica explícito.
+# O cliente padrão (e seu canal HTTP/2) é criado uma vez e compartilhado pelos
+# dois modelos, então o handshake TCP/TLS não se repete a cada chamada.
+genai.configure(api_key=GOOGLE_AI_API_KEY, transport='grpc')
+# O Flash atende a maioria das mensagens (basta identificar a ferramenta); o Pro
+# só entra quando a resposta do Flash vem longa e sem nenhum [COMANDO].
+model_flash = genai.GenerativeModel('gemini-flash-latest')
+model_pro = genai.GenerativeModel('gemini-2.5-pro')
+ESCALONAR_MIN_CHARS = 280
+
+# Limita as chamadas simultâneas ao Gemini (geração e upload), que rodam em
+# threads para não travar o event loop.
+GEMINI_MAX_CONCORRENCIA = 8
+GEMINI_SEM = asyncio.Semaphore(GEMINI_MAX_CONCORRENCIA)
+
+# --- FUNÇÕES DE BANCO DE DADOS ---
+
+DB_PATH = 'orion_memoria.db'
+DB_POOL_SIZE = 4
+DB_CACHED_STATEMENTS = 256
+
+# Pool de conexões reaproveitadas: evita abrir/fechar o arquivo a cada consulta
+# e mantém o cache de páginas do SQLite aquecido.
+_POOL = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+# WAL deixa as consultas lerem em paralelo com as escritas e, com
+# synchronous=NORMAL, reduz os fsyncs por commit.
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
 
-genai.configure(api_key=GOOGLE_AI_API_KEY)
-model = genai.GenerativeModel('gemini-2.5-pro')
+def _nova_conexao():
+    conn = sqlite3.connect(
+        DB_PATH,
+        check_same_thread=False,
+        isolation_level=None,
+        cached_statements=DB_CACHED_STATEMENTS
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
 
-# --- FUNÇÕES DE BANCO DE DADOS (Sem alterações) ---
+@contextmanager
+def get_conn():
+    try:
+        conn = _POOL.get_nowait()
+    except queue.Empty:
+        conn = _nova_conexao()
+    try:
+        yield conn
+    finally:
+        try:
+            _POOL.put_nowait(conn)
+        except queue.Full:
+            conn.close()
 
 def setup_database(): 
-    with sqlite3.connect('orion_memoria.db') as conn:
+    while not _POOL.full():
+        _POOL.put_nowait(_nova_conexao())
+
+    with get_conn() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS notas (
@@ -57,178 +125,179 @@ def setup_database():
             cursor.execute("ALTER TABLE notas ADD COLUMN due_at TIMESTAMP NULL")
         except sqlite3.OperationalError:
             pass
-                
-        conn.commit()
+
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notas_user_due ON notas(user_id, due_at)")
+        # Índice parcial de versões anteriores: o planner sempre preferiu o idx_notas_user_due.
+        cursor.execute("DROP INDEX IF EXISTS idx_notas_user_id_desc")
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS persistence (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+        ''')
+
+# SQL fixo em constantes: com o mesmo texto a cada chamada, o cache de
+# statements da conexão (cached_statements) reaproveita o prepare.
+_SQL_INSERIR = "INSERT INTO notas (user_id, content, due_at) VALUES (?, ?, ?)"
+_SQL_PENDENTES = "SELECT id, content, due_at FROM notas WHERE user_id = ? AND due_at IS NOT NULL AND due_at > ? ORDER BY due_at ASC"
+_SQL_CONCLUIDAS = "SELECT id, content, due_at FROM notas WHERE user_id = ? AND due_at IS NOT NULL AND due_at <= ? ORDER BY due_at DESC"
+_SQL_SIMPLES = "SELECT id, content, due_at FROM notas WHERE user_id = ? AND due_at IS NULL ORDER BY id DESC"
+_SQL_TODAS = """
+    SELECT id, content, due_at,
+           CASE WHEN due_at IS NULL THEN 2 WHEN due_at > ? THEN 0 ELSE 1 END AS bucket
+    FROM notas
+    WHERE user_id = ?
+    ORDER BY bucket,
+             CASE WHEN bucket = 0 THEN due_at END ASC,
+             CASE WHEN bucket = 1 THEN due_at END DESC,
+             id DESC
+"""
+_SQL_DELETAR = "DELETE FROM notas WHERE id = ?"
+
+# rows: lista de (user_id, content, due_at), gravadas numa única transação.
+def adicionar_notas_bulk(rows):
+    with get_conn() as conn:
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(_SQL_INSERIR, rows)
+            conn.execute("COMMIT")
+        except BaseException:
+            # Nunca devolve ao pool uma conexão com transação aberta.
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
 
 def adicionar_nota(user_id, content, due_at=None):
-    with sqlite3.connect('orion_memoria.db') as conn: 
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO notas (user_id, content, due_at) VALUES (?, ?, ?)",
-            (user_id, content, due_at)
-        )
-        conn.commit()
+    adicionar_notas_bulk([(user_id, content, due_at)])
 
 def consultar_notas_pendentes(user_id, now_datetime):
-    with sqlite3.connect('orion_memoria.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, content, due_at FROM notas WHERE user_id = ? AND due_at IS NOT NULL AND due_at > ? ORDER BY due_at ASC",
-            (user_id, now_datetime)
-        )
-        return cursor.fetchall()
+    with get_conn() as conn:
+        return conn.execute(_SQL_PENDENTES, (user_id, now_datetime)).fetchall()
 
 def consultar_notas_concluidas(user_id, now_datetime):
-    with sqlite3.connect('orion_memoria.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, content, due_at FROM notas WHERE user_id = ? AND due_at IS NOT NULL AND due_at <= ? ORDER BY due_at DESC",
-            (user_id, now_datetime)
-        )
-        return cursor.fetchall()
+    with get_conn() as conn:
+        return conn.execute(_SQL_CONCLUIDAS, (user_id, now_datetime)).fetchall()
 
 def consultar_notas_simples(user_id):
-    with sqlite3.connect('orion_memoria.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, content, due_at FROM notas WHERE user_id = ? AND due_at IS NULL ORDER BY id DESC",
-            (user_id,)
-        )
-        return cursor.fetchall()
+    with get_conn() as conn:
+        return conn.execute(_SQL_SIMPLES, (user_id,)).fetchall()
+
+# Retorna (pendentes, concluidas, simples) com uma única consulta.
+def consultar_notas_all(user_id, now_datetime):
+    with get_conn() as conn:
+        rows = conn.execute(_SQL_TODAS, (now_datetime, user_id)).fetchall()
+
+    buckets = ([], [], [])
+    for row in rows:
+        buckets[row['bucket']].append(row)
+    return buckets
 
 def deletar_nota(note_id):
-    with sqlite3.connect('orion_memoria.db') as conn: 
-        cursor = conn.cursor()
-        sql_command = "DELETE FROM notas WHERE id = ?"
-        data_tuple = (note_id,)
-        cursor.execute(sql_command, data_tuple)
-        conn.commit()
+    with get_conn() as conn: 
+        conn.execute(_SQL_DELETAR, (note_id,))
+
+# --- PERSISTÊNCIA DO BOT ---
+
+class SQLitePersistence(BasePersistence):
+    # Guarda o estado do bot na tabela `persistence`, uma linha por
+    # usuário/chat/conversa. Cada alteração vira um UPSERT de uma linha, em vez
+    # de regravar o arquivo inteiro como o PicklePersistence. O conteúdo de cada
+    # linha continua em pickle, então aceita os mesmos tipos que antes.
+
+    @staticmethod
+    def _carregar(kind):
+        with get_conn() as conn:
+            return conn.execute(
+                "SELECT key, data FROM persistence WHERE kind = ?",
+                (kind,)
+            ).fetchall()
+
+    @staticmethod
+    def _gravar(kind, key, data):
+        with get_conn() as conn:
+            conn.execute(
+                "INSERT INTO persistence (kind, key, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(kind, key) DO UPDATE SET data = excluded.data",
+                (kind, key, pickle.dumps(data))
+            )
 
-# --- FUNÇÕES DO BOT ---
+    @staticmethod
+    def _apagar(kind, key):
+        with get_conn() as conn:
+            conn.execute("DELETE FROM persistence WHERE kind = ? AND key = ?", (kind, key))
+
+    async def get_user_data(self):
+        rows = await asyncio.to_thread(self._carregar, 'user_data')
+        return {int(key): pickle.loads(data) for (key, data) in rows}
+
+    async def get_chat_data(self):
+        rows = await asyncio.to_thread(self._carregar, 'chat_data')
+        return {int(key): pickle.loads(data) for (key, data) in rows}
+
+    async def get_bot_data(self):
+        rows = await asyncio.to_thread(self._carregar, 'bot_data')
+        return pickle.loads(rows[0][1]) if rows else {}
+
+    async def get_callback_data(self):
+        rows = await asyncio.to_thread(self._carregar, 'callback_data')
+        if not rows:
+            return None
+        return pickle.loads(rows[0][1])
+
+    async def get_conversations(self, name):
+        rows = await asyncio.to_thread(self._carregar, f'conversation:{name}')
+        return {tuple(json.loads(key)): pickle.loads(data) for (key, data) in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        kind = f'conversation:{name}'
+        key = json.dumps(list(key))
+        if new_state is None:
+            await asyncio.to_thread(self._apagar, kind, key)
+        else:
+            await asyncio.to_thread(self._gravar, kind, key, new_state)
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user.first_name
-    await update.message.reply_html(
-        f"Orion v2.4 online, {user}. Correção de alucinação aplicada. Pronto para comandos."
-    )
+    async def update_user_data(self, user_id, data):
+        await asyncio.to_thread(self._gravar, 'user_data', str(user_id), data)
 
-async def enviar_lembrete(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    chat_id = job.chat_id
-    mensagem = job.data
-    await context.bot.send_message(chat_id=chat_id, text=f"🔔 ALERTA, BRENO:\n\n- {mensagem}")
+    async def update_chat_data(self, chat_id, data):
+        await asyncio.to_thread(self._gravar, 'chat_data', str(chat_id), data)
 
-async def process_gemini_response(full_response_text, user_id, update: Update, context: ContextTypes.DEFAULT_TYPE):
-    parts = full_response_text.split('\n')
-    natural_reply = parts[0].strip()
+    async def update_bot_data(self, data):
+        await asyncio.to_thread(self._gravar, 'bot_data', '', data)
 
-    await update.message.reply_text(natural_reply)
+    async def update_callback_data(self, data):
+        await asyncio.to_thread(self._gravar, 'callback_data', '', data)
 
-    command_line = None
-    if len(parts) > 1:
-        command_line = parts[-1].strip()
+    async def drop_user_data(self, user_id):
+        await asyncio.to_thread(self._apagar, 'user_data', str(user_id))
 
-    if not command_line or not command_line.startswith('[') or not command_line.endswith(']'):
-        return 
+    async def drop_chat_data(self, chat_id):
+        await asyncio.to_thread(self._apagar, 'chat_data', str(chat_id))
 
-    match = re.match(r"\[(\w+): (.*)\]", command_line)
-    
-    if not match:
-        if command_line != "[CONVERSAR]": 
-            await update.message.reply_text(f"(Debug: Não consegui entender o comando: {command_line})")
-        return
+    # Os dados já ficam em memória no Application e cada update_* grava na hora,
+    # então não há nada para recarregar nem para descarregar no flush.
+    async def refresh_user_data(self, user_id, user_data):
+        pass
 
-    intent = match.group(1) 
-    raw_data = match.group(2)
-    
-    if intent == "SALVAR_NOTA":
-        entity = raw_data.strip('"') 
-        if entity:
-            adicionar_nota(user_id, entity, due_at=None)
-        else:
-            await update.message.reply_text("Erro no processamento: a IA tentou salvar uma nota vazia.")
-    
-    elif intent == "AGENDAR_LEMBRETE":
-        try:
-            parts = raw_data.split('", "') 
-            entity = parts[0].strip('"')
-            lembrete_time_str = parts[1].strip('"')
-            
-            lembrete_time = datetime.strptime(lembrete_time_str, '%Y-%m-%d %H:%M:%S')
-            lembrete_time_aware = SAO_PAULO_TZ.localize(lembrete_time)
-            
-            context.job_queue.run_once(
-                enviar_lembrete, 
-                lembrete_time_aware,
-                chat_id=user_id, 
-                data=entity,
-                name=str(user_id) + lembrete_time_str
-            )
-            
-            adicionar_nota(user_id, entity, lembrete_time_aware)
-            
-        except Exception as e:
-            logging.error(f"Erro ao agendar lembrete: {e}. Raw data: {raw_data}")
-            await update.message.reply_text(f"Tentei agendar, mas falhei. A IA formatou a data/hora errado. (Erro: {e})")
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
 
-    elif intent == "CONSULTAR_NOTAS":
-        now_aware = datetime.now(SAO_PAULO_TZ)
-        
-        pendentes = consultar_notas_pendentes(user_id, now_aware)
-        concluidas = consultar_notas_concluidas(user_id, now_aware)
-        simples = consultar_notas_simples(user_id)
-        
-        resposta = "📝 **SEUS REGISTROS, BRENO:**\n\n"
-        
-        resposta += "⏰ **LEMBRETES PENDENTES (Para Fazer):**\n"
-        if not pendentes:
-            resposta += "  (Nenhum lembrete pendente)\n"
-        else:
-            for (note_id, content, due_at_str) in pendentes:
-                due_at_dt = datetime.fromisoformat(due_at_str)
-                data_formatada = due_at_dt.strftime('%d/%m às %H:%M')
-                resposta += f"  **ID {note_id}**: {content} (Para: {data_formatada})\n"
-        
-        resposta += "\n✅ **LEMBRETES CONCLUÍDOS (Já passaram):**\n"
-        if not concluidas:
-            resposta += "  (Nenhum lembrete concluído)\n"
-        else:
-            for (note_id, content, due_at_str) in concluidas:
-                due_at_dt = datetime.fromisoformat(due_at_str)
-                data_formatada = due_at_dt.strftime('%d/%m às %H:%M')
-                resposta += f"  **ID {note_id}**: {content} (Era: {data_formatada})\n"
-
-        resposta += "\n🗒️ **NOTAS SIMPLES:**\n"
-        if not simples:
-            resposta += "  (Nenhuma nota simples)\n"
-        else:
-            for (note_id, content, _) in simples:
-                resposta += f"  **ID {note_id}**: {content}\n"
-        
-        await update.message.reply_text(resposta, parse_mode='Markdown')
-    
-    elif intent == "DELETAR_NOTA_POR_ID":
-        note_id_str = raw_data.strip('"')
-        try:
-            note_id = int(note_id_str)
-            deletar_nota(note_id)
-        except ValueError:
-            await update.message.reply_text(f"Erro: A IA tentou apagar um ID inválido: {note_id_str}")
-        except Exception as e:
-            logging.error(f"Erro ao deletar nota: {e}")
-            await update.message.reply_text("Tentei apagar a nota, mas falhei.")
+    async def refresh_bot_data(self, bot_data):
+        pass
 
-# --- Handler de Texto (COM PROMPT CORRIGIDO) ---
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    text = update.message.text
-    
-    await update.message.reply_text(f"Processando...")
+    async def flush(self):
+        pass
+
+# --- PROMPTS ---
+# Montados uma única vez; por mensagem só são preenchidos {now} e {text}.
 
-    # --- (CORREÇÃO DE ALUCINAÇÃO 1: Prompt de texto mais rígido) ---
-    prompt = f"""
+# --- (CORREÇÃO DE ALUCINAÇÃO 1: Prompt de texto mais rígido) ---
+PROMPT_TEXT_TEMPLATE = """
         Você é Orion, um assistente de IA conversacional e executor de tarefas. Sua única missão é servir Breno como um assistente de alta performance.
-        (Contexto de Tempo Atual: {datetime.now(SAO_PAULO_TZ).strftime('%Y-%m-%d %H:%M:%S')})
+        (Contexto de Tempo Atual: {now})
 
         ### CAIXA DE FERRAMENTAS DISPONÍVEIS
         1.  [SALVAR_NOTA: "conteúdo_da_nota_aqui"]
@@ -251,37 +320,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         **Agora, analise e responda a esta mensagem do Breno:** '{text}'
     """
 
-    try:
-        response = model.generate_content(prompt)
-        full_response_text = response.text.strip()
-        
-        await process_gemini_response(full_response_text, user_id, update, context)
-
-    except Exception as e:
-        logging.error(f"Erro CRÍTICO ao processar mensagem: {e}")
-        await update.message.reply_text("Erro no processamento. Tente novamente.")
-
-# --- Handler de Áudio (COM PROMPT CORRIGIDO) ---
-async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    
-    await update.message.reply_text(f"Ouvindo... Processando áudio...")
-    
-    temp_path = None
-    try:
-        voice_file = await update.message.voice.get_file()
-        
-        temp_dir = tempfile.gettempdir()
-        temp_path = os.path.join(temp_dir, f"orion_audio_{update.update_id}.oga")
-        await voice_file.download_to_drive(temp_path)
-        
-        audio_file_for_gemini = genai.upload_file(path=temp_path)
-
-        # --- (CORREÇÃO DE ALUCINAÇÃO 2: Prompt de áudio mais rígido) ---
-        prompt = [
-            f"""
+# --- (CORREÇÃO DE ALUCINAÇÃO 2: Prompt de áudio mais rígido) ---
+PROMPT_AUDIO_TEMPLATE = """
             Você é Orion, um assistente de IA conversacional e executor de tarefas. Sua única missão é servir Breno.
-            (Contexto de Tempo Atual: {datetime.now(SAO_PAULO_TZ).strftime('%Y-%m-%d %H:%M:%S')})
+            (Contexto de Tempo Atual: {now})
             
             A entrada do usuário é um arquivo de ÁUDIO.
             
@@ -306,31 +348,386 @@ async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             4.  Peça Esclarecimento se o áudio for ambíguo (ex: "apague a nota").
             
             **Agora, analise o áudio do Breno e gere a resposta completa:**
-            """,
+            """
+
+# --- FUNÇÕES DO BOT ---
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user.first_name
+    await update.message.reply_html(
+        f"Orion v2.4 online, {user}. Correção de alucinação aplicada. Pronto para comandos."
+    )
+
+async def enviar_lembrete(context: ContextTypes.DEFAULT_TYPE):
+    job = context.job
+    chat_id = job.chat_id
+    mensagem = job.data
+    await context.bot.send_message(chat_id=chat_id, text=f"🔔 ALERTA, BRENO:\n\n- {mensagem}")
+
+# --- FILA DE ENVIO ---
+# As respostas dos comandos passam por uma fila consumida por um único worker,
+# que limita o ritmo abaixo do limite global do Telegram (30 msg/s) sem
+# segurar os handlers enquanto as mensagens saem.
+
+TX_QUEUE_SIZE = 1024
+TX_RATE = 25
+TX_POLL_INTERVAL = 1
+TX_MAX_TENTATIVAS = 3
+
+_TX_QUEUE = asyncio.Queue(maxsize=TX_QUEUE_SIZE)
+_TX_TASK = None
+
+async def enfileirar_envio(context: ContextTypes.DEFAULT_TYPE, chat_id, text, parse_mode=None):
+    # O worker nasce no primeiro envio, já com a aplicação rodando, para que o
+    # Application.create_task o acompanhe e o stop() espere a fila esvaziar.
+    global _TX_TASK
+    if _TX_TASK is None or _TX_TASK.done():
+        _TX_TASK = context.application.create_task(tx_worker(context.application), name="orion_tx_worker")
+
+    # Com a fila cheia, espera vaga em vez de estourar QueueFull no handler.
+    await _TX_QUEUE.put((chat_id, text, parse_mode))
+
+async def _enviar_sem_formatacao(bot, chat_id, text):
+    # Markdown inválido (_, *, [ dentro das notas) ou texto acima do limite:
+    # reenvia como texto puro, em partes. Se nem assim for, avisa o usuário.
+    try:
+        for inicio in range(0, len(text), MessageLimit.MAX_TEXT_LENGTH):
+            await bot.send_message(chat_id=chat_id, text=text[inicio:inicio + MessageLimit.MAX_TEXT_LENGTH])
+    except TelegramError as e:
+        logging.error(f"Falha ao reenviar mensagem sem formatação: {e}")
+        try:
+            await bot.send_message(chat_id=chat_id, text="Erro no processamento. Tente novamente.")
+        except TelegramError as e:
+            logging.error(f"Falha ao avisar erro de envio: {e}")
+
+async def _enviar(bot, chat_id, text, parse_mode):
+    for _ in range(TX_MAX_TENTATIVAS):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+            return
+        except RetryAfter as e:
+            espera = e.retry_after
+            if isinstance(espera, timedelta):
+                espera = espera.total_seconds()
+            logging.warning(f"Limite do Telegram atingido; aguardando {espera}s para reenviar.")
+            await asyncio.sleep(espera)
+        except BadRequest as e:
+            logging.error(f"Falha ao enviar mensagem da fila: {e}")
+            await _enviar_sem_formatacao(bot, chat_id, text)
+            return
+        except TelegramError as e:
+            # TimedOut/NetworkError: a mensagem pode ter chegado mesmo assim,
+            # então não reenvia para não duplicar.
+            logging.error(f"Falha ao enviar mensagem da fila: {e}")
+            return
+    logging.error(f"Mensagem para {chat_id} descartada após {TX_MAX_TENTATIVAS} tentativas.")
+
+async def tx_worker(application: Application):
+    # Roda enquanto a aplicação estiver ativa; no desligamento, termina de
+    # esvaziar a fila antes de sair.
+    while application.running or not _TX_QUEUE.empty():
+        try:
+            chat_id, text, parse_mode = await asyncio.wait_for(_TX_QUEUE.get(), TX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            continue
+        try:
+            await _enviar(application.bot, chat_id, text, parse_mode)
+        except Exception as e:
+            logging.error(f"Erro inesperado na fila de envio: {e}")
+        finally:
+            _TX_QUEUE.task_done()
+        await asyncio.sleep(1 / TX_RATE)
+
+# Intervalo mínimo entre edições da mensagem enquanto a resposta chega em stream.
+STREAM_MIN_CHARS = 20
+STREAM_MIN_INTERVAL = 0.2
+
+async def _editar_mensagem(mensagem, texto):
+    # Edição só de progresso: se o Telegram recusar (429, BadRequest), apenas
+    # registra; o stream segue e o [COMANDO] não se perde.
+    try:
+        return await mensagem.edit_text(texto)
+    except TelegramError as e:
+        logging.warning(f"Falha ao atualizar mensagem em stream: {e}")
+        return None
+
+async def gerar_resposta_em_stream(prompt, mensagem, modelo):
+    # Vai mostrando a resposta natural (primeira linha) na mensagem de espera
+    # conforme o Gemini gera; o [COMANDO] só é lido com o texto completo.
+    # O semáforo fica com o stream inteiro; as edições no Telegram rodam em
+    # tasks separadas (no máximo uma por vez) para não segurar a leitura.
+    texto = ""
+    exibido = mensagem.text
+    ultima_edicao = time.monotonic()
+    edicao = None  # (task, texto enviado)
+
+    async with GEMINI_SEM:
+        stream = await asyncio.to_thread(modelo.generate_content, prompt, stream=True)
+        chunks = iter(stream)
+
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            # Chunks sem Part (só finish_reason/uso, ou parada por segurança no
+            # meio) fazem o `.text` levantar ValueError; são simplesmente ignorados.
+            if chunk.candidates and chunk.candidates[0].content.parts:
+                texto += chunk.text
+
+            if edicao and edicao[0].done():
+                nova = edicao[0].result()
+                if nova:
+                    mensagem, exibido = nova, edicao[1]
+                edicao = None
+
+            prefixo = texto.lstrip().split('\n', 1)[0].strip()
+            agora = time.monotonic()
+            if (
+                edicao is None
+                and prefixo
+                and agora - ultima_edicao >= STREAM_MIN_INTERVAL
+                and len(prefixo) - len(exibido) >= STREAM_MIN_CHARS
+            ):
+                edicao = (asyncio.create_task(_editar_mensagem(mensagem, prefixo)), prefixo)
+                ultima_edicao = agora
+
+    if edicao:
+        nova = await edicao[0]
+        if nova:
+            mensagem = nova
+
+    if not texto.strip():
+        raise ValueError("O Gemini não retornou nenhum texto.")
+    return texto.strip(), mensagem
+
+# Última linha da resposta no formato [COMANDO: ...], ou None. Usada tanto
+# para decidir o escalonamento ao Pro quanto pelo process_gemini_response.
+def _linha_de_comando(texto):
+    linhas = texto.split('\n')
+    ultima = linhas[-1].strip()
+    if len(linhas) > 1 and ultima.startswith('[') and ultima.endswith(']'):
+        return ultima
+    return None
+
+async def gerar_resposta(prompt, mensagem):
+    # O Flash é chamado sem stream: só com a resposta completa dá para saber se
+    # ela vai ser trocada pela do Pro, e o usuário não deve ver uma resposta ser
+    # substituída por outra. Sem escalonamento, o texto do Flash aparece de uma
+    # vez no process_gemini_response; com escalonamento, o Pro vai sendo
+    # mostrado em stream.
+    async with GEMINI_SEM:
+        resposta = await asyncio.to_thread(model_flash.generate_content, prompt)
+    texto = resposta.text.strip()
+    if _linha_de_comando(texto) is None and len(texto) > ESCALONAR_MIN_CHARS:
+        logging.info("Resposta do Flash sem comando; repetindo com o Pro.")
+        texto, mensagem = await gerar_resposta_em_stream(prompt, mensagem, model_pro)
+    return texto, mensagem
+
+# --- COMANDOS DA IA ---
+
+_CMD_RE = re.compile(r"\[(\w+): (.*)\]")
+_AGENDAR_RE = re.compile(r'^"(?P<entity>.*)",\s*"(?P<when>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})"$')
+
+FORMATO_DATA_LEMBRETE = '%d/%m às %H:%M'
+
+async def _cmd_salvar(raw_data, user_id, update: Update, context: ContextTypes.DEFAULT_TYPE, now):
+    entity = raw_data.strip('"') 
+    if entity:
+        await asyncio.to_thread(adicionar_nota, user_id, entity, due_at=None)
+    else:
+        await enfileirar_envio(context, update.effective_chat.id, "Erro no processamento: a IA tentou salvar uma nota vazia.")
+
+async def _cmd_agendar(raw_data, user_id, update: Update, context: ContextTypes.DEFAULT_TYPE, now):
+    try:
+        match = _AGENDAR_RE.match(raw_data)
+        if not match:
+            raise ValueError("formato inesperado")
+        entity, lembrete_time_str = match['entity'], match['when']
+        
+        lembrete_time_aware = datetime.fromisoformat(lembrete_time_str).replace(tzinfo=SAO_PAULO_TZ)
+        
+        context.job_queue.run_once(
+            enviar_lembrete, 
+            lembrete_time_aware,
+            chat_id=user_id, 
+            data=entity,
+            name=str(user_id) + lembrete_time_str
+        )
+        
+        await asyncio.to_thread(adicionar_nota, user_id, entity, lembrete_time_aware)
+        
+    except Exception as e:
+        logging.error(f"Erro ao agendar lembrete: {e}. Raw data: {raw_data}")
+        await enfileirar_envio(context, update.effective_chat.id, f"Tentei agendar, mas falhei. A IA formatou a data/hora errado. (Erro: {e})")
+
+async def _cmd_consultar(raw_data, user_id, update: Update, context: ContextTypes.DEFAULT_TYPE, now):
+    pendentes, concluidas, simples = await asyncio.to_thread(consultar_notas_all, user_id, now)
+    
+    resposta = ["📝 **SEUS REGISTROS, BRENO:**\n\n"]
+    
+    resposta.append("⏰ **LEMBRETES PENDENTES (Para Fazer):**\n")
+    if not pendentes:
+        resposta.append("  (Nenhum lembrete pendente)\n")
+    else:
+        resposta.extend(
+            f"  **ID {row['id']}**: {row['content']} (Para: {datetime.fromisoformat(row['due_at']).strftime(FORMATO_DATA_LEMBRETE)})\n"
+            for row in pendentes
+        )
+    
+    resposta.append("\n✅ **LEMBRETES CONCLUÍDOS (Já passaram):**\n")
+    if not concluidas:
+        resposta.append("  (Nenhum lembrete concluído)\n")
+    else:
+        resposta.extend(
+            f"  **ID {row['id']}**: {row['content']} (Era: {datetime.fromisoformat(row['due_at']).strftime(FORMATO_DATA_LEMBRETE)})\n"
+            for row in concluidas
+        )
+
+    resposta.append("\n🗒️ **NOTAS SIMPLES:**\n")
+    if not simples:
+        resposta.append("  (Nenhuma nota simples)\n")
+    else:
+        resposta.extend(f"  **ID {row['id']}**: {row['content']}\n" for row in simples)
+    
+    await enfileirar_envio(context, update.effective_chat.id, "".join(resposta), parse_mode='Markdown')
+
+async def _cmd_deletar(raw_data, user_id, update: Update, context: ContextTypes.DEFAULT_TYPE, now):
+    note_id_str = raw_data.strip('"')
+    try:
+        note_id = int(note_id_str)
+        await asyncio.to_thread(deletar_nota, note_id)
+    except ValueError:
+        await enfileirar_envio(context, update.effective_chat.id, f"Erro: A IA tentou apagar um ID inválido: {note_id_str}")
+    except Exception as e:
+        logging.error(f"Erro ao deletar nota: {e}")
+        await enfileirar_envio(context, update.effective_chat.id, "Tentei apagar a nota, mas falhei.")
+
+_DISPATCH = {
+    "SALVAR_NOTA": _cmd_salvar,
+    "AGENDAR_LEMBRETE": _cmd_agendar,
+    "CONSULTAR_NOTAS": _cmd_consultar,
+    "DELETAR_NOTA_POR_ID": _cmd_deletar,
+}
+
+async def process_gemini_response(full_response_text, user_id, update: Update, context: ContextTypes.DEFAULT_TYPE, mensagem=None, now=None):
+    if now is None:
+        now = datetime.now(SAO_PAULO_TZ)
+
+    parts = full_response_text.split('\n')
+    natural_reply = parts[0].strip()
+
+    if mensagem is None:
+        await enfileirar_envio(context, update.effective_chat.id, natural_reply)
+    elif mensagem.text != natural_reply:
+        try:
+            await mensagem.edit_text(natural_reply)
+        except TelegramError as e:
+            logging.warning(f"Falha ao editar resposta, enviando nova mensagem: {e}")
+            await enfileirar_envio(context, update.effective_chat.id, natural_reply)
+
+    command_line = _linha_de_comando(full_response_text)
+    if not command_line:
+        return 
+
+    match = _CMD_RE.match(command_line)
+    
+    if not match:
+        if command_line != "[CONVERSAR]": 
+            await enfileirar_envio(context, update.effective_chat.id, f"(Debug: Não consegui entender o comando: {command_line})")
+        return
+
+    intent = match.group(1) 
+    raw_data = match.group(2)
+    
+    handler = _DISPATCH.get(intent)
+    if handler:
+        await handler(raw_data, user_id, update, context, now)
+
+# --- Handler de Texto (COM PROMPT CORRIGIDO) ---
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    text = update.message.text
+    
+    mensagem = await update.message.reply_text(f"Processando...")
+
+    now_aware = datetime.now(SAO_PAULO_TZ)
+    prompt = PROMPT_TEXT_TEMPLATE.format(
+        now=now_aware.strftime('%Y-%m-%d %H:%M:%S'),
+        text=text
+    )
+
+    try:
+        full_response_text, mensagem = await gerar_resposta(prompt, mensagem)
+        
+        await process_gemini_response(full_response_text, user_id, update, context, mensagem, now=now_aware)
+
+    except Exception as e:
+        logging.error(f"Erro CRÍTICO ao processar mensagem: {e}")
+        await update.message.reply_text("Erro no processamento. Tente novamente.")
+
+# --- CACHE DE ÁUDIO ---
+# Áudios repetidos (reenvio ou nova tentativa) reaproveitam o arquivo já
+# enviado ao Gemini, identificado pelo hash do conteúdo.
+
+AUDIO_CACHE_MAX = 128
+# Arquivos perto de expirar saem do cache antes, para não chegarem vencidos
+# ao generate_content.
+AUDIO_CACHE_MARGEM = timedelta(hours=1)
+
+_AUDIO_CACHE = {}
+
+async def obter_arquivo_audio(audio_buffer, display_name):
+    digest = hashlib.blake2b(audio_buffer.getbuffer(), digest_size=16).hexdigest()
+
+    agora = datetime.now(timezone.utc)
+    for chave in [k for (k, f) in _AUDIO_CACHE.items() if f.expiration_time - agora < AUDIO_CACHE_MARGEM]:
+        del _AUDIO_CACHE[chave]
+
+    arquivo = _AUDIO_CACHE.get(digest)
+    if arquivo is None:
+        async with GEMINI_SEM:
+            arquivo = await asyncio.to_thread(
+                genai.upload_file, path=audio_buffer, mime_type='audio/ogg', display_name=display_name
+            )
+        if len(_AUDIO_CACHE) >= AUDIO_CACHE_MAX:
+            del _AUDIO_CACHE[next(iter(_AUDIO_CACHE))]
+        _AUDIO_CACHE[digest] = arquivo
+    return arquivo
+
+# --- Handler de Áudio (COM PROMPT CORRIGIDO) ---
+async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    
+    mensagem = await update.message.reply_text(f"Ouvindo... Processando áudio...")
+    
+    try:
+        voice_file = await update.message.voice.get_file()
+        
+        audio_buffer = io.BytesIO()
+        await voice_file.download_to_memory(out=audio_buffer)
+        audio_buffer.seek(0)
+        
+        audio_file_for_gemini = await obter_arquivo_audio(audio_buffer, f"orion_audio_{update.update_id}.oga")
+
+        now_aware = datetime.now(SAO_PAULO_TZ)
+        prompt = [
+            PROMPT_AUDIO_TEMPLATE.format(now=now_aware.strftime('%Y-%m-%d %H:%M:%S')),
             audio_file_for_gemini
         ]
         
-        response = model.generate_content(prompt)
-        full_response_text = response.text.strip()
+        full_response_text, mensagem = await gerar_resposta(prompt, mensagem)
         
-        await process_gemini_response(full_response_text, user_id, update, context)
+        await process_gemini_response(full_response_text, user_id, update, context, mensagem, now=now_aware)
 
     except Exception as e:
         logging.error(f"Erro CRÍTICO ao processar ÁUDIO: {e}")
         await update.message.reply_text("Erro no processamento do áudio. Tente novamente.")
-    
-    finally:
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except Exception as e:
-                logging.error(f"Falha ao deletar arquivo temporário: {e}")
 
 # --- Função Principal ---
 def main() -> None:
     setup_database()
 
-    persistence = PicklePersistence(filepath="orion_lembretes_persistentes.pkl")
+    persistence = SQLitePersistence()
     application = Application.builder().token(TELEGRAM_TOKEN).persistence(persistence).build()
 
     application.add_handler(CommandHandler("start", start))